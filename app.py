@@ -2,8 +2,10 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import pickle
-import shap
-import matplotlib.pyplot as plt
+import hashlib
+import io
+import altair as alt
+from concurrent.futures import ThreadPoolExecutor
 
 st.set_page_config(
     page_title="Corporate Risk AI",
@@ -87,7 +89,17 @@ def load_data():
     import os
     model_path = os.path.join(os.path.dirname(__file__), 'models', 'financial_risk_model.pkl')
     with open(model_path, 'rb') as file:
-        return pickle.load(file)
+        bundle = pickle.load(file)
+    
+    # Spread tree traversal across all cores; the cached bundle keeps this setting across reruns
+    if hasattr(bundle["model"], "n_jobs"):
+        bundle["model"].n_jobs = -1
+    
+    # Keep scaler statistics in float32 so inputs stay half-width through scaling and prediction
+    scaler = bundle["scaler"]
+    scaler.mean_ = scaler.mean_.astype(np.float32)
+    scaler.scale_ = scaler.scale_.astype(np.float32)
+    return bundle
 
 try:
     data = load_data()
@@ -98,14 +110,157 @@ except FileNotFoundError:
     st.error("⚠️ Model file not found. Ensure 'models/financial_risk_model.pkl' is in the directory.")
     st.stop()
 
+# Risk Threshold (40% to account for base rate)
+THRESHOLD = 0.40
+
+# Training means, used to fill features missing from uploaded portfolios
+MEAN32 = scaler.mean_
+INV_SCALE32 = np.float32(1.0) / scaler.scale_
+FEATURE_INDEX = {name: i for i, name in enumerate(feature_names)}
+
+def scale_features(values):
+    """Standardize raw feature rows like scaler.transform, without sklearn's per-call input validation."""
+    return (values.astype(np.float32, copy=False) - MEAN32) * INV_SCALE32
+
 def get_mean_value(feature_name):
     """Retrieve the mean value of a feature from the training scaler to set neutral defaults."""
-    try:
-        names = list(feature_names)
-        idx = names.index(feature_name)
-        return float(scaler.mean_[idx])
-    except (ValueError, IndexError):
+    idx = FEATURE_INDEX.get(feature_name)
+    if idx is None:
         return 0.5
+    return float(scaler.mean_[idx])
+
+def predict_onnx(session, features_scaled):
+    """Score scaled rows with an ONNX Runtime session, deferring rows with missing values to sklearn."""
+    features_scaled = features_scaled.astype(np.float32, copy=False)
+    # Round off float32 accumulation noise so scores sitting exactly on the threshold compare as with sklearn
+    probabilities = np.round(session.run(None, {"input": features_scaled})[1][:, 1].astype(np.float64), 6)
+    
+    # Converted trees do not follow sklearn's learned direction for NaN, and blank CSV cells arrive as NaN
+    missing = np.isnan(features_scaled).any(axis=1)
+    if missing.any():
+        probabilities[missing] = model.predict_proba(features_scaled[missing])[:, 1]
+    return probabilities
+
+@st.cache_resource
+def get_onnx_session(_model, n_features):
+    """Compile the tree model into an ONNX Runtime session, or return None to fall back to sklearn."""
+    try:
+        import onnxruntime as ort
+        from skl2onnx import convert_sklearn
+        from skl2onnx.common.data_types import FloatTensorType
+    except ImportError:
+        return None
+    
+    # An unsupported estimator or a skl2onnx/scikit-learn version mismatch must not break every assessment
+    try:
+        onnx_model = convert_sklearn(
+            _model,
+            initial_types=[("input", FloatTensorType([None, n_features]))],
+            options={id(_model): {"zipmap": False}}
+        )
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session = ort.InferenceSession(onnx_model.SerializeToString(), sess_options=options, providers=["CPUExecutionProvider"])
+    except Exception as e:
+        print(f"Warning: ONNX conversion failed ({e}); using sklearn for inference.")
+        return None
+    
+    # Parity check on standardized rows, half of them with missing values, before trusting the session
+    rng = np.random.default_rng(0)
+    probe = rng.standard_normal((256, n_features)).astype(np.float32)
+    probe[128:][rng.random((128, n_features)) < 0.05] = np.nan
+    if not np.allclose(predict_onnx(session, probe), _model.predict_proba(probe)[:, 1], atol=1e-5):
+        print("Warning: ONNX model disagrees with sklearn; using sklearn for inference.")
+        return None
+    return session
+
+def predict_risk(features_scaled):
+    """Return the 'Risk' class probability of each scaled row, using ONNX Runtime when available."""
+    session = get_onnx_session(model, len(feature_names))
+    if session is None:
+        return model.predict_proba(features_scaled)[:, 1]
+    return predict_onnx(session, features_scaled)
+
+@st.cache_data
+def build_template(columns):
+    """Serialize the empty CSV template once per set of feature columns."""
+    return pd.DataFrame(columns=list(columns)).to_csv(index=False).encode('utf-8')
+
+@st.cache_resource
+def get_executor():
+    """Shared worker pool for background work that can overlap with page rendering."""
+    return ThreadPoolExecutor(max_workers=2)
+
+@st.cache_resource(max_entries=16)
+def encode_report(report_key, _report_df):
+    """Start serializing an audit report to CSV in the background, once per uploaded file and risk threshold."""
+    return get_executor().submit(lambda: _report_df.to_csv(index=False).encode('utf-8'))
+
+def read_portfolio(file):
+    """Parse an uploaded CSV, preferring the multi-threaded PyArrow reader; identifier columns are kept for the report."""
+    try:
+        return pd.read_csv(file, engine="pyarrow")
+    except ImportError:
+        file.seek(0)
+        return pd.read_csv(file)
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def score_portfolio(file_bytes):
+    """Score an uploaded portfolio CSV; re-uploads of identical bytes are served from the cache."""
+    batch_df = read_portfolio(io.BytesIO(file_bytes))
+    if batch_df.empty:
+        raise ValueError("the uploaded file contains no rows")
+    
+    # Align columns: fill missing features with training mean to ensure neutral prediction
+    n_rows = len(batch_df)
+    aligned = np.broadcast_to(MEAN32, (n_rows, len(feature_names))).copy()
+    present = [i for i, name in enumerate(feature_names) if name in batch_df.columns]
+    aligned[:, present] = batch_df[[feature_names[i] for i in present]].to_numpy(dtype=np.float32)
+    
+    batch_scaled = scale_features(aligned)
+    probabilities = predict_risk(batch_scaled)
+    
+    batch_df['Risk_Score'] = probabilities
+    batch_df['Status'] = pd.Categorical(
+        np.where(probabilities > THRESHOLD, 'HIGH RISK', 'Stable'),
+        categories=['Stable', 'HIGH RISK']
+    )
+    return batch_df, batch_scaled, probabilities
+
+@st.cache_resource
+def get_explainer(_model):
+    """Build the SHAP tree explainer once per process and reuse it across reruns."""
+    # Imported on first use so batch-only sessions never load the SHAP dependency tree
+    try:
+        import fasttreeshap
+        # FastTreeSHAP v2 precomputes per-tree lookup tables at construction, paid once thanks to the cache
+        return fasttreeshap.TreeExplainer(_model, algorithm="v2", n_jobs=-1, shortcut=False)
+    except Exception:
+        # Not installed, or a release that fails under NumPy 2 (np.obj2sctype was removed)
+        import shap
+        return shap.TreeExplainer(_model)
+
+@st.cache_resource
+def get_driver_chart():
+    """Build the static SHAP driver chart layers once; each assessment only binds its top features as data."""
+    bars = alt.Chart().mark_bar().encode(
+        x=alt.X('SHAP Value:Q', title="Impact on Risk Score"),
+        y=alt.Y('Feature:N', sort=None, title=None),
+        color=alt.Color('Color:N', scale=None)
+    )
+    zero_line = alt.Chart(pd.DataFrame({'x': [0]})).mark_rule(color='black', strokeDash=[4, 4]).encode(x='x:Q')
+    return bars, zero_line
+
+def positive_class_shap(shap_values):
+    """Select the SHAP values of the 'Risk' class from a TreeExplainer output."""
+    if isinstance(shap_values, list):
+        return shap_values[1]
+    return shap_values[:, :, 1]
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def portfolio_shap_values(upload_key, _batch_scaled):
+    """Compute 'Risk' class SHAP values for every row of the portfolio in one pass, once per uploaded file."""
+    return positive_class_shap(get_explainer(model).shap_values(_batch_scaled, check_additivity=False))
 
 # ==========================================
 # 2. Sidebar - Global Settings
@@ -126,6 +281,63 @@ st.markdown("### AI-Powered Financial Health Diagnostics")
 
 tab1, tab2 = st.tabs(["🏢 Single Company Simulator", "📂 Batch Portfolio Audit"])
 
+@st.fragment
+def run_single_assessment(input_scaled):
+    """Prediction and SHAP panel; clicking the button reruns only this fragment, not the whole script."""
+    if st.button("Run Risk Assessment", key="single_sim_btn"):
+        with st.spinner("Analyzing financial indicators..."):
+            probability = predict_risk(input_scaled)[0]
+            prediction_class = probability > THRESHOLD
+            
+            res_col1, res_col2 = st.columns([1, 1])
+            
+            with res_col1:
+                st.markdown('<div class="metric-card">', unsafe_allow_html=True)
+                st.markdown("#### Risk Probability Score")
+                
+                st.markdown(f"<h1 style='font-size: 3.5em; color: {'#e74c3c' if prediction_class else '#27ae60'};'>{probability:.1%}</h1>", unsafe_allow_html=True)
+                
+                if prediction_class:
+                    st.markdown('<div class="risk-badge">⚠️ HIGH RISK DETECTED</div>', unsafe_allow_html=True)
+                    st.markdown(f"<p style='margin-top:10px;'>Risk Score exceeds safety threshold of {THRESHOLD:.0%}. The company exhibits strong signals of financial distress.</p>", unsafe_allow_html=True)
+                else:
+                    st.markdown('<div class="safe-badge">✅ FINANCIALLY STABLE</div>', unsafe_allow_html=True)
+                    st.markdown(f"<p style='margin-top:10px;'>Risk Score is below safety threshold of {THRESHOLD:.0%}. Current metrics suggest a healthy financial outlook.</p>", unsafe_allow_html=True)
+                
+                st.progress(float(probability))
+                st.markdown('</div>', unsafe_allow_html=True)
+
+            with res_col2:
+                st.markdown('<div class="metric-card">', unsafe_allow_html=True)
+                st.markdown("#### Key Risk Drivers (SHAP Analysis)")
+                st.markdown("<p style='font-size:0.9em; color:#666;'>Factors pushing the model towards 'Risk' (Right) or 'Safe' (Left).</p>", unsafe_allow_html=True)
+                
+                try:
+                    explainer = get_explainer(model)
+                    shap_values = explainer.shap_values(input_scaled, check_additivity=False)
+                    
+                    sv = positive_class_shap(shap_values)[0]
+                    
+                    # Partition out the 5 largest |SHAP| values, then order only those
+                    abs_sv = np.abs(sv)
+                    top_k = min(5, len(abs_sv))
+                    top_idx = np.argpartition(abs_sv, -top_k)[-top_k:]
+                    top_idx = top_idx[np.argsort(-abs_sv[top_idx])]
+                    
+                    top_features = pd.DataFrame({
+                        'Feature': [feature_names[i] for i in top_idx],
+                        'SHAP Value': sv[top_idx],
+                        'Color': np.where(sv[top_idx] > 0, '#ff4b4b', '#00cc96')
+                    })
+                    
+                    # Vega-Lite spec rendered in the browser instead of a server-side Matplotlib PNG
+                    bars, zero_line = get_driver_chart()
+                    st.altair_chart(bars.properties(data=top_features) + zero_line, use_container_width=True)
+                except Exception as e:
+                    st.warning(f"Could not generate SHAP explanation: {e}")
+                
+                st.markdown('</div>', unsafe_allow_html=True)
+
 # TAB 1: Single Company Simulator
 with tab1:
     st.markdown("**Interactive Stress Testing**: Adjust the key financial levers below to simulate a specific company's operating scenario.")
@@ -173,84 +385,19 @@ with tab1:
     }
     
     # Initialize with average values for all features to represent a neutral company
-    input_values = scaler.mean_.reshape(1, -1)
-    input_df = pd.DataFrame(input_values, columns=feature_names)
+    input_values = scaler.mean_.reshape(1, -1).copy()
     
     # Update specifically adjusted features
     for col, value in user_data.items():
-        if col in input_df.columns:
-            input_df[col] = value
-    input_scaled = scaler.transform(input_df)
+        idx = FEATURE_INDEX.get(col)
+        if idx is not None:
+            input_values[0, idx] = value
+    input_scaled = scale_features(input_values)
 
     st.markdown("---")
     st.markdown("### 🔍 Analysis Results")
 
-    if st.button("Run Risk Assessment", key="single_sim_btn"):
-        with st.spinner("Analyzing financial indicators..."):
-            probability = model.predict_proba(input_scaled)[0][1]
-            
-            # Risk Threshold (40% to account for base rate)
-            THRESHOLD = 0.40
-            prediction_class = probability > THRESHOLD
-            
-            res_col1, res_col2 = st.columns([1, 1])
-            
-            with res_col1:
-                st.markdown('<div class="metric-card">', unsafe_allow_html=True)
-                st.markdown("#### Risk Probability Score")
-                
-                st.markdown(f"<h1 style='font-size: 3.5em; color: {'#e74c3c' if prediction_class else '#27ae60'};'>{probability:.1%}</h1>", unsafe_allow_html=True)
-                
-                if prediction_class:
-                    st.markdown('<div class="risk-badge">⚠️ HIGH RISK DETECTED</div>', unsafe_allow_html=True)
-                    st.markdown(f"<p style='margin-top:10px;'>Risk Score exceeds safety threshold of {THRESHOLD:.0%}. The company exhibits strong signals of financial distress.</p>", unsafe_allow_html=True)
-                else:
-                    st.markdown('<div class="safe-badge">✅ FINANCIALLY STABLE</div>', unsafe_allow_html=True)
-                    st.markdown(f"<p style='margin-top:10px;'>Risk Score is below safety threshold of {THRESHOLD:.0%}. Current metrics suggest a healthy financial outlook.</p>", unsafe_allow_html=True)
-                
-                st.progress(float(probability))
-                st.markdown('</div>', unsafe_allow_html=True)
-
-            with res_col2:
-                st.markdown('<div class="metric-card">', unsafe_allow_html=True)
-                st.markdown("#### Key Risk Drivers (SHAP Analysis)")
-                st.markdown("<p style='font-size:0.9em; color:#666;'>Factors pushing the model towards 'Risk' (Right) or 'Safe' (Left).</p>", unsafe_allow_html=True)
-                
-                try:
-                    explainer = shap.TreeExplainer(model)
-                    shap_values = explainer.shap_values(input_scaled)
-                    
-                    if isinstance(shap_values, list):
-                        sv = shap_values[1][0]
-                    else:
-                        sv = shap_values[0, :, 1]
-                    
-                    shap_df = pd.DataFrame({
-                        'Feature': feature_names,
-                        'SHAP Value': sv
-                    })
-                    top_features = shap_df.reindex(shap_df["SHAP Value"].abs().sort_values(ascending=False).index).head(5)
-                    
-                    fig, ax = plt.subplots(figsize=(5, 3))
-                    colors = ['#ff4b4b' if x > 0 else '#00cc96' for x in top_features['SHAP Value']]
-                    
-                    y_pos = np.arange(len(top_features))
-                    ax.barh(y_pos, top_features['SHAP Value'], color=colors)
-                    ax.set_yticks(y_pos)
-                    ax.set_yticklabels(top_features['Feature'], fontsize=9)
-                    ax.set_xlabel("Impact on Risk Score", fontsize=8)
-                    ax.axvline(0, color='black', linewidth=0.8, linestyle='--')
-                    ax.invert_yaxis()
-                    
-                    ax.spines['right'].set_visible(False)
-                    ax.spines['top'].set_visible(False)
-                    ax.spines['left'].set_visible(False)
-                    
-                    st.pyplot(fig, use_container_width=True)
-                except Exception as e:
-                    st.warning(f"Could not generate SHAP explanation: {e}")
-                
-                st.markdown('</div>', unsafe_allow_html=True)
+    run_single_assessment(input_scaled)
 
 # TAB 2: Batch Portfolio Audit
 with tab2:
@@ -268,8 +415,7 @@ with tab2:
         st.markdown("Download the standard CSV template to prepare your data.")
         
         # Download Template Logic
-        dummy_data = pd.DataFrame(columns=feature_names)
-        csv_template = dummy_data.to_csv(index=False).encode('utf-8')
+        csv_template = build_template(tuple(feature_names))
         
         st.download_button(
             label="� Download CSV Template",
@@ -289,29 +435,18 @@ with tab2:
     if uploaded_file is not None:
         try:
             with st.spinner("Scanning portfolio..."):
-                batch_df = pd.read_csv(uploaded_file)
-                
-                # Align columns: fill missing features with training mean to ensure neutral prediction
-                n_rows = len(batch_df)
-                mean_matrix = np.tile(scaler.mean_, (n_rows, 1))
-                aligned_df = pd.DataFrame(mean_matrix, columns=feature_names)
-                
-                for col in batch_df.columns:
-                    if col in aligned_df.columns:
-                        aligned_df[col] = batch_df[col]
+                file_bytes = uploaded_file.getvalue()
+                upload_key = hashlib.sha256(file_bytes).hexdigest()
+                batch_df, batch_scaled, probabilities = score_portfolio(file_bytes)
                 
-                batch_scaled = scaler.transform(aligned_df)
-                probabilities = model.predict_proba(batch_scaled)[:, 1]
-                
-                THRESHOLD = 0.40
-                batch_df['Risk_Score'] = probabilities
-                batch_df['Status'] = np.where(probabilities > THRESHOLD, 'HIGH RISK', 'Stable')
+                # Encode the report while the findings and styled table are being rendered
+                report_future = encode_report(f"{upload_key}:{THRESHOLD}", batch_df)
                 
                 st.markdown("---")
                 st.subheader("Audit Findings")
                 
                 m_col1, m_col2, m_col3 = st.columns(3)
-                high_risk_count = batch_df[batch_df['Status'] == 'HIGH RISK'].shape[0]
+                high_risk_count = int((batch_df['Status'].cat.codes == 1).sum())
                 avg_risk = probabilities.mean()
                 
                 with m_col1:
@@ -325,7 +460,7 @@ with tab2:
                 
                 # Simple function to color rows in st.dataframe or st.data_editor
                 def highlight_risk(s):
-                    return ['background-color: #ffebee' if v == 'HIGH RISK' else 'background-color: #e8f5e9' for v in s]
+                    return np.where(s.cat.codes == 1, 'background-color: #ffebee', 'background-color: #e8f5e9').tolist()
                 
                 # Show key columns first
                 display_cols = ['Risk_Score', 'Status'] + [c for c in batch_df.columns if c not in ['Risk_Score', 'Status']]
@@ -335,15 +470,22 @@ with tab2:
                     use_container_width=True
                 )
                 
-                result_csv = batch_df.to_csv(index=False).encode('utf-8')
                 st.download_button(
                     label="📥 Download Risk Audit Report",
-                    data=result_csv,
+                    data=report_future.result(),
                     file_name="risk_audit_results.csv",
                     mime="text/csv",
                     key="download_report"
                 )
 
+                if st.checkbox("Compute SHAP for portfolio", key="portfolio_shap", help="Explain the risk drivers across all uploaded companies."):
+                    with st.spinner("Explaining portfolio risk drivers..."):
+                        portfolio_sv = portfolio_shap_values(upload_key, batch_scaled)
+                    
+                    st.markdown("#### Portfolio Risk Drivers (Mean |SHAP|)")
+                    mean_impact = pd.Series(np.abs(portfolio_sv).mean(axis=0), index=feature_names)
+                    st.bar_chart(mean_impact.nlargest(10))
+
         except Exception as e:
             st.error(f"Error processing file: {e}")
 
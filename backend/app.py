@@ -1,8 +1,18 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
-import pandas as pd
+from sklearn.linear_model import LogisticRegression
+from joblib import Parallel, delayed
+import joblib
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.targets import ValueTarget
 import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pac
+import orjson
 import pickle
+import functools
+import hashlib
+import gzip
 import os
 
 app = Flask(__name__)
@@ -10,9 +20,28 @@ CORS(app)
 
 # Load model and data
 MODEL_PATH = os.path.join(os.path.dirname(__file__), '..', 'models', 'financial_risk_model.pkl')
+MMAP_MODEL_PATH = os.path.join(os.path.dirname(__file__), '..', 'models', 'financial_risk_model.joblib')
 
+def file_sha256(path):
+    """Hash a file in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while chunk := file.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+@functools.cache
 def load_model():
-    """Load model, scaler, and metadata from pickle file."""
+    """Load model, scaler, and metadata, preferring the joblib export from models/resave_model.py while it is current."""
+    if os.path.exists(MMAP_MODEL_PATH):
+        # Only plain arrays such as the scaler statistics stay memory-mapped; sklearn copies tree nodes onto the heap
+        data = joblib.load(MMAP_MODEL_PATH, mmap_mode='r')
+        # The export records the pickle it was made from; a different pickle means the model was re-exported since
+        if not os.path.exists(MODEL_PATH) or data.get('source_sha256') == file_sha256(MODEL_PATH):
+            print(f"Loading model from {MMAP_MODEL_PATH}")
+            return data
+        print(f"Warning: {MMAP_MODEL_PATH} is stale; re-run models/resave_model.py. Using the pickle instead.")
+    print(f"Loading model from {MODEL_PATH}")
     with open(MODEL_PATH, 'rb') as file:
         return pickle.load(file)
 
@@ -27,15 +56,152 @@ except FileNotFoundError:
     scaler = None
     feature_names = []
 
+FEATURE_INDEX = {name: i for i, name in enumerate(feature_names)}
+FEATURE_SET = frozenset(feature_names)
+MEAN_ROW = scaler.mean_.astype(np.float32) if scaler is not None else None
+SCALE = scaler.scale_.astype(np.float32) if scaler is not None else None
 THRESHOLD = 0.40
 
+# A binary logistic regression absorbs the scaler into its weights: w' = w / scale, b' = b - mean . w'
+if isinstance(model, LogisticRegression) and len(model.classes_) == 2:
+    LINEAR_WEIGHTS = (model.coef_[0] / scaler.scale_).astype(np.float32)
+    LINEAR_BIAS = float(model.intercept_[0] - scaler.mean_ @ (model.coef_[0] / scaler.scale_))
+else:
+    LINEAR_WEIGHTS = None
+    LINEAR_BIAS = None
+
+def predict_onnx(session, X):
+    """Score scaled float32 rows with an ONNX Runtime session, deferring rows with missing values to sklearn."""
+    # Rounding drops float32 accumulation noise so scores sitting exactly on the threshold compare as with sklearn
+    probabilities = np.round(session.run(None, {'input': X})[1][:, 1].astype(np.float64), 6)
+    
+    # Converted trees do not follow sklearn's learned direction for NaN, and blank CSV cells arrive as NaN
+    missing = np.isnan(X).any(axis=1)
+    if missing.any():
+        probabilities[missing] = model.predict_proba(X[missing])[:, 1]
+    return probabilities
+
+def build_onnx_session():
+    """Compile the tree model into an ONNX Runtime session, or return None to fall back to sklearn."""
+    try:
+        import onnxruntime as ort
+        from skl2onnx import convert_sklearn
+        from skl2onnx.common.data_types import FloatTensorType
+    except ImportError:
+        return None
+    
+    # An unsupported estimator or a skl2onnx/scikit-learn version mismatch must not take the API down
+    try:
+        onnx_model = convert_sklearn(
+            model,
+            initial_types=[('input', FloatTensorType([None, len(feature_names)]))],
+            options={id(model): {'zipmap': False}}
+        )
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session = ort.InferenceSession(onnx_model.SerializeToString(), sess_options=options, providers=['CPUExecutionProvider'])
+    except Exception as e:
+        print(f"Warning: ONNX conversion failed ({e}); using sklearn for inference.")
+        return None
+    
+    # Parity check on standardized rows, half of them with missing values, before trusting the session
+    rng = np.random.default_rng(0)
+    probe = rng.standard_normal((256, len(feature_names))).astype(np.float32)
+    probe[128:][rng.random((128, len(feature_names))) < 0.05] = np.nan
+    if not np.allclose(predict_onnx(session, probe), model.predict_proba(probe)[:, 1], atol=1e-5):
+        print("Warning: ONNX model disagrees with sklearn; using sklearn for inference.")
+        return None
+    return session
+
+ONNX_SESSION = build_onnx_session() if model is not None and LINEAR_WEIGHTS is None else None
+
+# Below this many rows, thread dispatch costs more than it saves
+PARALLEL_MIN_ROWS = 10_000
+
+# Multipart bodies are fed to the upload parser in chunks of this size
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Parse feature columns straight to float64 so blank or integer-looking columns need no inference or casting
+CSV_CONVERT_OPTIONS = pac.ConvertOptions(column_types={name: pa.float64() for name in feature_names})
+
+def scale_inplace(X):
+    """Standardize a float32 feature matrix in place, avoiding the copies made by scaler.transform."""
+    np.subtract(X, MEAN_ROW, out=X)
+    np.divide(X, SCALE, out=X)
+    return X
+
+def predict_risk(X):
+    """Return the 'Risk' class probability of each raw feature row; X may be scaled in place."""
+    if LINEAR_WEIGHTS is not None:
+        # Scaling is folded into the weights, so one matrix-vector product replaces transform + predict_proba
+        return 1.0 / (1.0 + np.exp(-(X @ LINEAR_WEIGHTS + LINEAR_BIAS)))
+    
+    X = scale_inplace(X)
+    if ONNX_SESSION is not None:
+        # ONNX Runtime's C++ tree kernels parallelize internally
+        return predict_onnx(ONNX_SESSION, X)
+    
+    if len(X) > PARALLEL_MIN_ROWS:
+        # Tree prediction releases the GIL, so row chunks can be scored on parallel threads
+        chunks = np.array_split(X, os.cpu_count() or 1)
+        probabilities = Parallel(n_jobs=-1, backend='threading')(
+            delayed(model.predict_proba)(chunk) for chunk in chunks
+        )
+        return np.concatenate(probabilities)[:, 1]
+    return model.predict_proba(X)[:, 1]
+
+def read_uploaded_file(field='file'):
+    """Stream the multipart request body through the form parser and return the uploaded file's bytes, or None."""
+    parser = StreamingFormDataParser(headers=request.headers)
+    target = ValueTarget()
+    parser.register(field, target)
+    
+    while chunk := request.stream.read(UPLOAD_CHUNK_SIZE):
+        parser.data_received(chunk)
+    
+    if target.multipart_filename is None:
+        return None
+    return target.value
+
+def json_response(payload, status=200):
+    """Encode a JSON response with orjson, which is several times faster than flask.jsonify and serializes NumPy values natively."""
+    return Response(orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY), status=status, mimetype='application/json')
+
+def precompress_json(payload):
+    """Serialize a static JSON payload once, keeping plain and gzip encodings with their ETags."""
+    body = orjson.dumps(payload)
+    etag = hashlib.sha1(body).hexdigest()
+    return {
+        'identity': (body, etag),
+        'gzip': (gzip.compress(body), etag + '-gzip')
+    }
+
+def static_json_response(encodings):
+    """Serve a precompressed JSON payload, gzipped when accepted and as 304 when the client's ETag matches."""
+    encoding = 'gzip' if 'gzip' in request.accept_encodings else 'identity'
+    body, etag = encodings[encoding]
+    
+    response = Response(body, mimetype='application/json')
+    if encoding == 'gzip':
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+# Static payloads only depend on the loaded model, so they are built once at import
+FEATURES_PAYLOAD = precompress_json({
+    'features': [
+        {'name': name, 'default': default, 'min': 0.0, 'max': 1.0}
+        for name, default in zip(feature_names, scaler.mean_.tolist())
+    ]
+}) if scaler is not None else None
+TEMPLATE_PAYLOAD = precompress_json({'columns': list(feature_names)})
+HEALTH_PAYLOAD = precompress_json({'status': 'healthy', 'model_loaded': model is not None})
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint."""
-    return jsonify({
-        'status': 'healthy',
-        'model_loaded': model is not None
-    })
+    return static_json_response(HEALTH_PAYLOAD)
 
 @app.route('/api/features', methods=['GET'])
 def get_features():
@@ -43,15 +209,7 @@ def get_features():
     if scaler is None:
         return jsonify({'error': 'Model not loaded'}), 500
     
-    features = []
-    for i, name in enumerate(feature_names):
-        features.append({
-            'name': name,
-            'default': float(scaler.mean_[i]),
-            'min': 0.0,
-            'max': 1.0
-        })
-    return jsonify({'features': features})
+    return static_json_response(FEATURES_PAYLOAD)
 
 @app.route('/api/predict/single', methods=['POST'])
 def predict_single():
@@ -63,38 +221,44 @@ def predict_single():
         user_data = request.json
         
         # Initialize with mean values
-        input_values = scaler.mean_.reshape(1, -1)
-        input_df = pd.DataFrame(input_values, columns=feature_names)
+        input_values = MEAN_ROW.copy()
         
         # Update with user-provided values
         for col, value in user_data.items():
-            if col in input_df.columns:
-                input_df[col] = value
+            idx = FEATURE_INDEX.get(col)
+            if idx is not None:
+                # Nulls and strings would otherwise become NaN in the float arrays and be scored silently
+                if not isinstance(value, (int, float)) or not np.isfinite(value):
+                    return jsonify({'error': f"Feature '{col}' must be a finite number"}), 400
+                input_values[idx] = value
         
-        input_scaled = scaler.transform(input_df)
-        probability = model.predict_proba(input_scaled)[0][1]
+        probability = predict_risk(input_values.reshape(1, -1))[0]
         prediction_class = probability > THRESHOLD
         
         # Calculate feature importance (simplified SHAP-like analysis)
         feature_impacts = []
-        for i, name in enumerate(feature_names):
-            if name in user_data:
-                # Calculate deviation from mean
-                deviation = user_data[name] - scaler.mean_[i]
-                feature_impacts.append({
-                    'feature': name,
-                    'value': float(user_data[name]),
-                    'impact': float(deviation * 0.1)  # Simplified impact calculation
-                })
-        
-        # Sort by absolute impact
-        feature_impacts.sort(key=lambda x: abs(x['impact']), reverse=True)
+        user_keys = [name for name in user_data if name in FEATURE_INDEX]
+        if user_keys:
+            values = np.array([user_data[name] for name in user_keys], dtype=np.float64)
+            # Deviation from mean, scaled as a simplified impact calculation
+            impacts = (values - scaler.mean_[[FEATURE_INDEX[name] for name in user_keys]]) * 0.1
+            
+            # Partition out the 5 largest absolute impacts, then sort only those
+            abs_impacts = np.abs(impacts)
+            top_k = min(5, len(impacts))
+            top = np.argpartition(-abs_impacts, top_k - 1)[:top_k]
+            top = top[np.argsort(-abs_impacts[top], kind='stable')]
+            
+            feature_impacts = [
+                {'feature': user_keys[i], 'value': values[i], 'impact': impacts[i]}
+                for i in top
+            ]
         
-        return jsonify({
-            'probability': float(probability),
-            'isHighRisk': bool(prediction_class),
+        return json_response({
+            'probability': probability,
+            'isHighRisk': prediction_class,
             'threshold': THRESHOLD,
-            'featureImpacts': feature_impacts[:5]
+            'featureImpacts': feature_impacts
         })
     
     except Exception as e:
@@ -107,47 +271,58 @@ def predict_batch():
         return jsonify({'error': 'Model not loaded'}), 500
     
     try:
-        if 'file' not in request.files:
+        file_bytes = read_uploaded_file()
+        if file_bytes is None:
             return jsonify({'error': 'No file provided'}), 400
         
-        file = request.files['file']
-        batch_df = pd.read_csv(file)
+        table = pac.read_csv(pa.BufferReader(file_bytes), convert_options=CSV_CONVERT_OPTIONS)
+        if table.num_rows == 0:
+            return jsonify({'error': 'Uploaded file contains no rows'}), 400
         
-        # Align columns with training features
-        n_rows = len(batch_df)
-        mean_matrix = np.tile(scaler.mean_, (n_rows, 1))
-        aligned_df = pd.DataFrame(mean_matrix, columns=feature_names)
+        # Align columns with training features in a row-major float32 matrix, so prediction reads
+        # half-width rows sequentially (sklearn trees evaluate in float32 anyway)
+        n_rows = table.num_rows
+        X = np.empty((n_rows, len(feature_names)), dtype=np.float32, order='C')
         
-        for col in batch_df.columns:
-            if col in aligned_df.columns:
-                aligned_df[col] = batch_df[col]
+        # Each cell is written once: means go only into the columns the upload lacks
+        usable_cols = [col for col in table.column_names if col in FEATURE_SET]
+        provided = frozenset(usable_cols)
+        missing_idx = [FEATURE_INDEX[name] for name in feature_names if name not in provided]
+        if missing_idx:
+            X[:, missing_idx] = MEAN_ROW[missing_idx]
         
-        batch_scaled = scaler.transform(aligned_df)
-        probabilities = model.predict_proba(batch_scaled)[:, 1]
+        for col in usable_cols:
+            X[:, FEATURE_INDEX[col]] = table.column(col).to_numpy()
+        
+        probabilities = predict_risk(X)
         
         # Prepare results
-        results = []
-        for i, row in batch_df.iterrows():
-            risk_score = float(probabilities[i])
-            results.append({
-                'id': i + 1,
-                'riskScore': risk_score,
-                'status': 'HIGH RISK' if risk_score > THRESHOLD else 'Stable',
-                'data': row.to_dict()
-            })
+        high_risk_mask = probabilities > THRESHOLD
+        risk_scores = probabilities.tolist()
+        statuses = np.where(high_risk_mask, 'HIGH RISK', 'Stable').tolist()
         
-        high_risk_count = sum(1 for r in results if r['status'] == 'HIGH RISK')
-        avg_risk = float(probabilities.mean())
+        high_risk_count = int(high_risk_mask.sum())
+        summary = {
+            'totalCompanies': n_rows,
+            'highRiskCount': high_risk_count,
+            'stableCount': n_rows - high_risk_count,
+            'averageRisk': probabilities.mean()
+        }
         
-        return jsonify({
-            'results': results,
-            'summary': {
-                'totalCompanies': len(results),
-                'highRiskCount': high_risk_count,
-                'stableCount': len(results) - high_risk_count,
-                'averageRisk': avg_risk
-            }
-        })
+        def generate():
+            # Encode one record batch at a time so peak memory stays flat and the client
+            # starts receiving results while later rows are still being serialized
+            yield b'{"results":['
+            i = 0
+            for batch in table.to_batches():
+                for record in batch.to_pylist():
+                    yield (b',' if i else b'') + orjson.dumps(
+                        {'id': i + 1, 'riskScore': risk_scores[i], 'status': statuses[i], 'data': record}
+                    )
+                    i += 1
+            yield b'],"summary":' + orjson.dumps(summary, option=orjson.OPT_SERIALIZE_NUMPY) + b'}'
+        
+        return Response(stream_with_context(generate()), mimetype='application/json')
     
     except Exception as e:
         return jsonify({'error': str(e)}), 400
@@ -155,10 +330,9 @@ def predict_batch():
 @app.route('/api/template', methods=['GET'])
 def get_template():
     """Get CSV template columns."""
-    return jsonify({
-        'columns': list(feature_names)
-    })
+    return static_json_response(TEMPLATE_PAYLOAD)
 
 if __name__ == '__main__':
-    app.run(debug=True, port=5000)
+    # Local development only; serve with gunicorn in production (see README)
+    app.run(port=5000)
 
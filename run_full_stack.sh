@@ -44,7 +44,7 @@ fi
 
 # Start Backend in background
 echo "[Backend] Starting Flask API on port 5000..."
-python app.py &
+gunicorn -w 4 --threads 4 -b 127.0.0.1:5000 app:app &
 BACKEND_PID=$!
 
 # Wait a moment for backend to initialize